@@ -13,17 +13,117 @@ from cbc_sdk.platform import Event
 import os
 import logging
 import json
-import csv
-from queue import Queue
+import re
+import threading
+from queue import Queue, Empty
+from functools import lru_cache
+from operator import itemgetter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 # External dependencies
 from tqdm import tqdm
-from anytree import AnyNode
-from anytree.exporter import JsonExporter
+# Optional dependencies
+try:
+    import orjson
+except ImportError:
+    orjson = None
 # Project
 from . import transforms
 
 log = logging.getLogger(__name__)
 
+def _dumps(obj):
+    """Returns the compact JSON representation of the given object, using orjson when available.
+
+    Without orjson, or for objects it cannot serialise (e.g. integers beyond 64 bits), the json module is used with the same
+    separators and raw UTF-8 characters, so the output is alike (though not identical, e.g. NaN is written as null by orjson).
+    """
+    if orjson:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+# Buffer size (bytes) used when writing the CSV files
+CSV_BUFFER_SIZE = 1 << 20
+# Number of rows written at once to the CSV file
+CSV_BATCH_SIZE = 1024
+# Header of the CSV files (same line terminator as the csv module)
+CSV_HEADER = "event_timestamp,event_type,event_description,summary,details\r\n"
+# Characters that require a CSV field to be quoted
+_CSV_SPECIAL = re.compile(r'[,"\r\n]')
+# Number of events fetched in advance from the CBC API while the previous ones are being written
+PREFETCH_SIZE = 2048
+# Number of CSV files written concurrently when the events are split into chunks
+CSV_WRITERS = 4
+# Number of processes whose events are exported concurrently when following the process tree
+EXPORT_WORKERS = 8
+# Fields retrieved for the childproc events when following the process tree
+CHILDPROC_FIELDS = ["process_guid", "childproc_process_guid", "childproc_pid", "childproc_name"]
+
+@lru_cache(maxsize=8)
+def _load_summary(summary_file):
+    """Returns the summary attributes read from the summary file. They are cached by path and must not be modified.
+    """
+    with open(summary_file) as f:
+        return json.load(f)
+
+def _csv_line(row):
+    """Returns the CSV line of the given row, quoting the fields as the csv module does by default (QUOTE_MINIMAL).
+    """
+    fields = []
+    for value in row:
+        value = '' if value is None else str(value)
+        if _CSV_SPECIAL.search(value):
+            value = '"' + value.replace('"', '""') + '"'
+        fields.append(value)
+    return ','.join(fields) + '\r\n'
+
+def _prefetch(iterable, maxsize=PREFETCH_SIZE):
+    """Iterates over the given iterable from a background thread, so fetching the next items (network) overlaps with
+    processing the current ones (formatting and writing).
+
+    Any exception raised while iterating is raised again to the caller.
+
+    Args:
+        - iterable (iterable): Items to iterate over, e.g. the events query.
+        - maxsize (int): Maximum number of items fetched in advance.
+    """
+    items = Queue(maxsize=maxsize)
+    stop = threading.Event()
+    end = object()
+    error = []
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                items.put(item)
+        except BaseException as ex:
+            error.append(ex)
+        finally:
+            items.put(end)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is end:
+                if error:
+                    raise error[0]
+                return
+            yield item
+    finally:
+        # The consumer stopped (finished or failed): releases the producer if it is waiting on a full queue
+        stop.set()
+        try:
+            while True:
+                items.get_nowait()
+        except Empty:
+            pass
+
 class CBCProcessEventsReader(object):
     """Retrieves events and/or children processes from a process.
 
@@ -90,7 +190,7 @@ class CBCProcessEventsReader(object):
             childprocs.set_time_range(window=window)
         elif start and end:
             childprocs.set_time_range(start=start, end=end)
-        childprocs.set_fields(["process_guid", "childproc_process_guid", "childproc_pid", "childproc_name"])
+        childprocs.set_fields(CHILDPROC_FIELDS)
         
         return childprocs
 
@@ -104,57 +204,182 @@ class CBCProcessEventsWriter(object):
         Args:
             - summary_file (str): Path to the summary file (JSON) that contains the fields and transforms to apply when exporting events to file.
         """
-        # Reads the summary attributes.            
-        with open(summary_file) as f:
-            self._attributes = json.load(f)
+        # Reads the summary attributes (only once per summary file).
+        self._attributes = _load_summary(summary_file)
         self._summary_file = summary_file
+        # Resolves once the fields and transforms of each event type, so the export loop does not have to
+        self._plan = self._build_summary_plan()
+        # Event types missing from the summary file which have already been reported
+        self._warned = set()
+
+    def _build_summary_plan(self):
+        """Builds the summary plan from the summary attributes.
+
+        Returns:
+            plan (dict): Event type mapped to a (getter, keys, fields) tuple, where getter returns the tuple of values of the fields from the event
+                document, keys is the frozenset of those fields and fields is a list of (field, transform function or None) tuples.
+        """
+        plan = {}
+        for event_type, fields in self._attributes['types'].items():
+            resolved = []
+            for k in fields:
+                func = None
+                transform = self._attributes['transforms'].get(k)
+                if transform is not None:
+                    # https://docs.python.org/3/faq/programming.html#how-do-i-use-strings-to-call-functions-methods
+                    func = getattr(transforms, transform, None)
+                    if func is None:
+                        # The attribute is left out of the summary
+                        log.warning(f"The transform {transform} for the attribute {k} does not exist. Review the summary JSON file {self._summary_file}")
+                        continue
+                resolved.append((k, func))
+            keys = tuple(k for k, _ in resolved)
+            # itemgetter only returns a tuple when given several keys
+            if len(keys) > 1:
+                getter = itemgetter(*keys)
+            else:
+                getter = lambda doc, keys=keys: tuple(doc[k] for k in keys)
+            plan[event_type] = (getter, frozenset(keys), resolved)
+        return plan
     
-    def write_events_to_csv(self, guid, events, outfile):
+    def _event_to_row(self, event):
+        """Returns the CSV row of an event.
+
+        Args:
+            - event (cbc_sdk.platform.Event): Event to export
+
+        Returns:
+            row (tuple): event_timestamp, event_type, event_description, summary and details of the event.
+        """
+        # Summary attributes
+        parts = []
+        plan = self._plan.get(event.event_type)
+        if plan is None:
+            # Only reported once per event type
+            if event.event_type not in self._warned:
+                self._warned.add(event.event_type)
+                log.warning(f"The event type {event.event_type} does not exist. Review the summary JSON file {self._summary_file} if you want it to be included in the summary column")
+        else:
+            getter, keys, fields = plan
+            doc = event.original_document
+            if doc.keys() >= keys:
+                values = getter(doc)
+            else:
+                # Some of the fields are missing in this event (e.g. regmod_new_name is only set on rename)
+                values = [doc.get(k) for k, _ in fields]
+            for (k, func), val in zip(fields, values):
+                try:
+                    # Apply transform?
+                    parts.append(f" {k}: {func(val) if func else val}")
+                except:
+                    log.warning(f"The attribute {k} does not exist for this event type {event.event_type}. Review the summary JSON file {self._summary_file}")
+        summary = ''.join(parts)
+        return (event.event_timestamp, event.event_type, event.get('event_description'), summary, _dumps(event.original_document))
+
+    def _write_csv(self, events, outfile):
+        """Write the events into a single CSV file.
+
+        Args:
+            - events (iterable of cbc_sdk.platform.Event): Events to export
+            - outfile (str): Path to CSV file to write to
+
+        Returns:
+            count (int): Number of events written.
+        """
+        count = 0
+        # Export them to a CSV file (1 MiB buffer to amortise the write syscalls over many rows)
+        with open(outfile, 'w', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE) as csv_file:
+            # The columns are fixed, so the lines are formatted directly rather than through the csv module
+            csv_file.write(CSV_HEADER)
+            batch = []
+            for event in events:
+                count += 1
+                batch.append(_csv_line(self._event_to_row(event)))
+                if len(batch) >= CSV_BATCH_SIZE:
+                    csv_file.write(''.join(batch))
+                    batch.clear()
+            # Export the remaining events
+            csv_file.write(''.join(batch))
+
+        return count
+
+    def write_events_to_csv(self, guid, events, outfile, chunk_size=None):
         """Write the list of events into a CSV file.
 
+        If chunk_size is given, the events are split into several CSV files of (at most) chunk_size events each, which are
+        written concurrently. They are named after outfile adding the part number, e.g. events.part0.csv, events.part1.csv, etc.
+        and are not merged back together.
+
         Args:
             - guid (str): Process GUID.
             - events (list of cbc_sdk.platform.Event): List of events to export
             - outfile (str): Path to CSV file to write to
+            - chunk_size (int): Number of events per CSV file. If not given, all the events are written into outfile.
+
+        Returns:
+            count (int): Number of events written.
+
+        Raises:
+            ValueError: If chunk_size is lower than 1.
         """
-        
-        # Export them to a CSV file
-        with open(outfile, 'w', newline='', encoding='utf-8') as csv_file:
-            wr = csv.writer(csv_file, delimiter=",")
-            # Header
-            wr.writerow(["event_timestamp","event_type","event_description", "summary", "details"])
-            # Loop on the events
-            for event in tqdm(events, desc=f"Exporting events from process: {guid}"):
-                # Summary attributes
-                summary = ''
-                try:
-                    for k in self._attributes['types'][event.event_type]:
-                        try:
-                            val = event.get(k)
-                            # Apply transform?
-                            if k in self._attributes['transforms']:
-                                # https://docs.python.org/3/faq/programming.html#how-do-i-use-strings-to-call-functions-methods
-                                func = getattr(transforms, self._attributes['transforms'][k])
-                                val = func(val)
-
-                            summary += f" {k}: {val}"
-                        except:
-                            log.warning(f"The attribute {k} does not exist for this event type {event.event_type}. Review the summary JSON file {self._summary_file}")
-                except:
-                    log.warning(f"The event type {event.event_type} does not exist. Review the summary JSON file {self._summary_file} if you want it to be included in the summary column")
-                # Export event            
-                wr.writerow([event.event_timestamp, event.event_type, event.get('event_description'), summary, json.dumps(event.original_document)])
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError(f"The chunk size must be a positive integer, got {chunk_size}")
+        # Loop on the events as they are fetched (in the background), without asking the query for its length first
+        events = tqdm(_prefetch(events), desc=f"Exporting events from process: {guid}", unit=" events")
+        if chunk_size is None:
+            return self._write_csv(events, outfile)
+
+        root, ext = os.path.splitext(outfile)
+        count = 0
+        part = 0
+        pending = set()
+        executor = ThreadPoolExecutor(max_workers=CSV_WRITERS)
+        try:
+            chunk = []
+            for event in events:
+                chunk.append(event)
+                if len(chunk) >= chunk_size:
+                    pending.add(executor.submit(self._write_csv, chunk, f"{root}.part{part}{ext}"))
+                    part += 1
+                    chunk = []
+                    # Do not fetch further events than the writers can handle
+                    if len(pending) >= CSV_WRITERS:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    else:
+                        done, pending = wait(pending, timeout=0)
+                    # Raises any writer error (e.g. disk full) before fetching further events
+                    count += sum(future.result() for future in done)
+            if chunk:
+                pending.add(executor.submit(self._write_csv, chunk, f"{root}.part{part}{ext}"))
+            count += sum(future.result() for future in pending)
+            executor.shutdown()
+        except BaseException:
+            # The chunks not written yet are dropped
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        return count
 
-    def write_process_tree_to_json(self, root, outfile):
+    def write_process_tree_to_json(self, tree, outfile):
         """Write process tree into a JSON file.
+
+        The flat list of nodes is nested (children under the "children" key of their parent) before being written.
         
         Args:
-            - root (AnyNode): Root now from which to get the process tree
+            - tree (list of dict): Nodes of the process tree, the root being the first one. Each node references its parent by its index.
             - outfile (str): Path to JSON file where to write the process tree.
         """
-        exporter = JsonExporter(ensure_ascii=False, indent=4)
-        with open(outfile, 'w', encoding='utf-8') as fd:
-            exporter.write(root, fd)
+        nested = [{k: v for k, v in node.items() if k != 'parent'} for node in tree]
+        # Parents always come before their children
+        for node, parent in zip(nested[1:], tree[1:]):
+            nested[parent['parent']].setdefault('children', []).append(node)
+        # orjson only supports an indentation of 2 spaces, which is used as well without it for consistency
+        if orjson:
+            with open(outfile, 'wb') as fd:
+                fd.write(orjson.dumps(nested[0], option=orjson.OPT_INDENT_2))
+        else:
+            with open(outfile, 'w', encoding='utf-8') as fd:
+                json.dump(nested[0], fd, ensure_ascii=False, indent=2)
 
 class CBCProcessEventsExporter(object):
     """Class responsible for exporting process events and process trees
@@ -172,7 +397,7 @@ class CBCProcessEventsExporter(object):
         self._reader = CBCProcessEventsReader(profile)
         self._writer = CBCProcessEventsWriter(summary_file)
     
-    def export_process_events(self, process_guid, start, end, outfile):
+    def export_process_events(self, process_guid, start, end, outfile, chunk_size=None):
         """Export into CSV file the events associated to the given process within the given timeframe.
 
         Args:
@@ -180,14 +405,17 @@ class CBCProcessEventsExporter(object):
             - start (str): ISO 8601 timestamp from where to start to search for. It is used in combination with end.
             - end (str): ISO 8601 timestamp to limit the result search. It is used in combination with start.
             - outfile (str): Path to CSV file to write to
+            - chunk_size (int): Number of events per CSV file. If given, the events are split into several CSV files named after outfile.
         """
         events = self._reader.get_events(process_guid, start=start, end=end)
-        if len(events) > 0:
-            self._writer.write_events_to_csv(process_guid, events, outfile)
-        else:
+        # Events are streamed to the file, so an empty export is only known once written
+        if self._writer.write_events_to_csv(process_guid, events, outfile, chunk_size=chunk_size) == 0:
+            # No chunk file is created when there are no events
+            if chunk_size is None:
+                os.remove(outfile)
             log.info(f"No events to export from this process {process_guid}")
     
-    def export_process_tree_events(self, process_guid, start, end, outpath, depth_max=1):
+    def export_process_tree_events(self, process_guid, start, end, outpath, depth_max=1, max_workers=EXPORT_WORKERS, chunk_size=None):
         """Export into CSV file the events associated to the given process within the given timeframe as well as the events associated
         to the children processes limited to given depth.
 
@@ -200,40 +428,68 @@ class CBCProcessEventsExporter(object):
             - end (str): ISO 8601 timestamp to limit the result search. It is used in combination with start.
             - outpath (str): Path where to save the export files.
             - depth_max (int): Maximum depth
+            - max_workers (int): Maximum number of processes whose events are exported concurrently. The CBC API session keeps up to
+                10 connections alive, so more than 9 workers end up opening new connections.
+            - chunk_size (int): Number of events per CSV file. If given, the events of each process are split into several CSV files.
         """
 
-        # Using FIFO queue to avoid recursion in favour of performance
-        nodes = Queue()
-        depth = 0
-        # Creates the process tree root node
-        # https://anytree.readthedocs.io/en/latest/api/anytree.node.html
-        root = AnyNode(guid=process_guid, name='', pid='', level=depth)
+        # Computed once, as it is the same for every exported file (ends with the path separator, if any path)
+        prefix = os.path.join(outpath, "")
+        # Level by level traversal (FIFO deques of indexes in the process tree) to avoid recursion in favour of performance
+        current, nxt = deque(), deque()
+        # Creates the process tree as a flat list of nodes, each one referencing its parent by index. The first one is the root.
+        tree = [{'guid': process_guid, 'name': '', 'pid': '', 'level': 0, 'parent': -1}]
+        root = tree[0]
         # Adds the first node to process
-        nodes.put(root)
-        while not nodes.empty() and depth < depth_max:
-            # Get the next node to process
-            parent = nodes.get()
-            # Export the events to its dedicated file
-            outfile = os.path.join(outpath, f"{parent.level}_{parent.guid}.csv")
-            self.export_process_events(parent.guid, start, end, outfile)
-            # Get children nodes
-            depth += 1
-            children = self._reader.get_children(parent.guid, start=start, end=end)
-            for child in tqdm(children, desc=f"(Depth: {depth}) Querying childprocs from {parent.guid}"):
-                # Add child node to the process tree
-                node = AnyNode(guid=child.childproc_process_guid, name=child.childproc_name, pid=child.childproc_pid, level=depth, parent=parent)
-                # Add childe node to the queue for next iteration
-                nodes.put(node)
-
-        # Exports the events of the remaining nodes
-        while not nodes.empty():
-            node = nodes.get()
-            # Export the events to its dedicated file
-            outfile = os.path.join(outpath, f"{node.level}_{node.guid}.csv")
-            self.export_process_events(node.guid, start, end, outfile)
+        current.append(0)
+        # GUIDs already in the process tree: each process is exported once, as concurrent exports must not share a file
+        seen = {process_guid}
+        # The events of each process are independent, so they are exported in the background (I/O bound)
+        # while the process tree keeps being traversed.
+        futures = []
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            for depth in range(1, depth_max + 1):
+                while current:
+                    # Get the next node to process
+                    parent_idx = current.popleft()
+                    parent = tree[parent_idx]
+                    # Export the events to its dedicated file
+                    outfile = f"{prefix}{parent['level']}_{parent['guid']}.csv"
+                    futures.append(executor.submit(self.export_process_events, parent['guid'], start, end, outfile, chunk_size))
+                    # Get children nodes
+                    children = self._reader.get_children(parent['guid'], start=start, end=end)
+                    for child in tqdm(children, desc=f"(Depth: {depth}) Querying childprocs from {parent['guid']}"):
+                        if child.childproc_process_guid in seen:
+                            continue
+                        seen.add(child.childproc_process_guid)
+                        # Add child node to the process tree
+                        tree.append({'guid': child.childproc_process_guid, 'name': child.childproc_name, 'pid': child.childproc_pid, 'level': depth, 'parent': parent_idx})
+                        # Add child node to the queue of the next level
+                        nxt.append(len(tree) - 1)
+                # Next level
+                current, nxt = nxt, deque()
+
+            # Exports the events of the nodes of the last level
+            while current:
+                node = tree[current.popleft()]
+                # Export the events to its dedicated file
+                outfile = f"{prefix}{node['level']}_{node['guid']}.csv"
+                futures.append(executor.submit(self.export_process_events, node['guid'], start, end, outfile, chunk_size))
+
+            # Waits for the exports to finish
+            executor.shutdown()
+        except BaseException:
+            # Stops at once (e.g. Ctrl-C or a failed query): the exports not started yet are dropped
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        # Raises any exception that happened while exporting the events
+        for future in futures:
+            future.result()
 
         # Exports the process tree
-        outfile = os.path.join(outpath, f"{root.level}_{root.guid}-process_tree.json")
-        self._writer.write_process_tree_to_json(root, outfile)
+        outfile = f"{prefix}{root['level']}_{root['guid']}-process_tree.json"
+        self._writer.write_process_tree_to_json(tree, outfile)
         tqdm.write(f"Process tree exported to {outfile}")
 
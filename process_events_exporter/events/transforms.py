@@ -7,10 +7,12 @@
 It contains helper functions, such as transform functions.
 """
 
-import socket
-import struct
+from functools import lru_cache
 
+@lru_cache(maxsize=4096)
 def int2ip(ip):
     """Returns the string representation of an IPv4 in CIDR format from an IPv4 in integer format.
-    """    
-    return str(socket.inet_ntoa(struct.pack('>i',ip)))
\ No newline at end of file
+
+    Signed integers (as returned by CBC) are supported by masking each octet.
+    """
+    return f"{(ip >> 24) & 0xff}.{(ip >> 16) & 0xff}.{(ip >> 8) & 0xff}.{ip & 0xff}"
@@ -14,11 +14,23 @@ import logging
 import argparse
 import os
 import sys
+from functools import lru_cache
 from events.exporter import CBCProcessEventsExporter
 from tqdm.contrib.logging import logging_redirect_tqdm
 
 log = logging.getLogger(__name__)
 
+def positive_int(value):
+    """Argument type that only accepts positive integers.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
 def build_arg_parser():
     """Creates an Argument parser
 
@@ -30,6 +42,7 @@ def build_arg_parser():
     - follow_childprocs: Number of nesting levels to follow children processes to build and the process tree.
     - summary: Path to the JSON file that contains the attributes of the different event types to be included in the summary column.
     - outfile: Path to the CSV file where to export the events.
+    - chunk_size: Number of events per CSV file, to split the export into several files written concurrently.
     - verbose: Flag to enable debug logging.
     """
 
@@ -42,11 +55,24 @@ def build_arg_parser():
     parser.add_argument("--follow_childprocs", help="Number of nesting levels to follow children processes to build and the process tree", default=0)
     parser.add_argument("--summary", help="Path to the file that contains the attributes of the different event types to be included in the summary", required=True)
     parser.add_argument("--outfile", help="Path to the out file where to write", required=True)
+    parser.add_argument("--chunk_size", help="Number of events per CSV file, to split the export into several files written concurrently", type=positive_int, default=None)
     parser.add_argument("--verbose", help="enable debug logging", default=False, action='store_true')
 
     return parser
 
-def export_events_from_process(profile, summary_file, outfile, guid, start, end):
+@lru_cache(maxsize=None)
+def get_exporter(profile, summary_file):
+    """Returns the exporter for the given profile and summary file.
+
+    The exporter is created only once per profile and summary file, so the CBC API session (and its connections) is reused.
+
+    Args:
+        - profile (str): CBC profile to use. See more: https://carbon-black-cloud-python-sdk.readthedocs.io/en/latest/authentication
+        - summary_file (str): Path to the summary file (JSON) that contains the fields and transforms to apply when exporting events to file.
+    """
+    return CBCProcessEventsExporter(profile, summary_file)
+
+def export_events_from_process(profile, summary_file, outfile, guid, start, end, exporter=None, chunk_size=None):
     """Exports the events related to a process within a defined timeframe to a CSV file.
 
     Uses the Carbon Black Cloud API SDK to search for Events related to a given Process GUID in a defined timeframe, and
@@ -64,12 +90,14 @@ def export_events_from_process(profile, summary_file, outfile, guid, start, end)
         - guid (str): CBC Process GUID
         - start (str): ISO 8601 timestamp from where to start to search for. It is used in combination with end.
         - end (str): ISO 8601 timestamp to limit the result search. It is used in combination with start.
+        - exporter (CBCProcessEventsExporter): Exporter to use. If not given, the shared one for the profile and summary file is used.
+        - chunk_size (int): Number of events per CSV file. If given, the events are split into several CSV files named after outfile (e.g. events.part0.csv).
     """
-    exporter = CBCProcessEventsExporter(profile, summary_file)
-    exporter.export_process_events(guid, start, end, outfile)
+    exporter = exporter or get_exporter(profile, summary_file)
+    exporter.export_process_events(guid, start, end, outfile, chunk_size=chunk_size)
 
 
-def export_events_from_process_tree(profile, summary_file, outpath, guid, start, end, depth_max):
+def export_events_from_process_tree(profile, summary_file, outpath, guid, start, end, depth_max, exporter=None, chunk_size=None):
     """Exports the events related to each process (childproc) in the process tree as well as the process tree itself.
 
     The process events are exported into CSV file similarly to the method "export_events_from_process", while the process tree is exported
@@ -83,9 +111,11 @@ def export_events_from_process_tree(profile, summary_file, outpath, guid, start,
         - start (str): ISO 8601 timestamp from where to start to search for. It is used in combination with end.
         - end (str): ISO 8601 timestamp to limit the result search. It is used in combination with start.
         - depth_max (int): Maximum depth level to traverse in the process tree.
+        - exporter (CBCProcessEventsExporter): Exporter to use. If not given, the shared one for the profile and summary file is used.
+        - chunk_size (int): Number of events per CSV file. If given, the events of each process are split into several CSV files.
     """
-    exporter = CBCProcessEventsExporter(profile, summary_file)
-    exporter.export_process_tree_events(guid, start, end, outpath, depth_max)
+    exporter = exporter or get_exporter(profile, summary_file)
+    exporter.export_process_tree_events(guid, start, end, outpath, depth_max, chunk_size=chunk_size)
 
 if __name__ == "__main__":
     # Parse arguments
@@ -107,7 +137,7 @@ if __name__ == "__main__":
     with logging_redirect_tqdm():
         if depth > 0:
             outpath = os.path.dirname(args.outfile)
-            export_events_from_process_tree(args.profile, args.summary_file, outpath, args.guid, args.start, args.end, depth)
+            export_events_from_process_tree(args.profile, args.summary, outpath, args.guid, args.start, args.end, depth, chunk_size=args.chunk_size)
         else:
-            export_events_from_process(args.profile, args.summary, args.outfile, args.guid, args.start, args.end)
+            export_events_from_process(args.profile, args.summary, args.outfile, args.guid, args.start, args.end, chunk_size=args.chunk_size)
     
\ No newline at end of file